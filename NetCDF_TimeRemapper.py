@@ -36,84 +36,282 @@
 # setting up metadata about the output produced by the filter, before any data is requested (without allocating data yet)
 
 import vtk
+import concurrent.futures
+import marshal
+import os
 import re
+import sys
 import numpy as np
 
+# Time files with more lines than this are parsed with several threads or, if their lines have different lengths, with numba (see below).
+# For smaller files the threads or the numba compilation (redone on every parse, as the script can't be cached) cost more than they save
+large_time_file_lines = 50000
+
 # This file will contain the new custom times in this format: -4000-01-01T00:00:00, each time on a new row
 # Modify this path according to the location of your time file
 time_file = r"F:\CLEMENS\PARAVIEW_DATETIME_LIST_BCE.txt"
 
-if hasattr(self, "custom_times"):    
-    delattr(self, "custom_times")
-  
-if hasattr(self, "orig_times"):    
-    delattr(self, "orig_times")
+# Matches the non-empty, non-comment lines of the time file, without the surrounding whitespace
+time_line_re = re.compile(r"^[^\S\n]*([^#\s][^\n]*?)[^\S\n]*$", re.M)
+
+# Matches the fixed-width '-4000-01-01T00:00:00' format (the year might have a minus sign), only with ASCII digits like numpy
+iso_date_re = re.compile(r"(-?\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)", re.ASCII)
+
+# Returns the number of days from 1970-01-01 to the given date in the proleptic Gregorian calendar (H. Hinnant's days_from_civil).
+# Like numpy, this uses astronomical year numbering, i.e. there is a year 0, so it works with BCE dates as well
+def days_from_civil(y, m, d):
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((m + 9) % 12) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+# Returns the number of days of the given month (the arguments might also be numpy arrays)
+def days_in_month(y, m):
+    return days_from_civil(y + (m == 12), m % 12 + 1, 1) - days_from_civil(y, m, 1)
+
+# Converts a date/time string in the common fixed-width format to seconds since 1970-01-01T00:00:00.
+# This is computed directly with integer arithmetic, which is faster than numpy's general parser.
+# Returns None for anything else (e.g. fractional seconds or out of range values), these lines are left to numpy
+def iso_to_seconds(s):
+    match = iso_date_re.fullmatch(s)
+    if match:
+        y, mo, d, h, mi, sec = map(int, match.groups())
+        if 1 <= mo <= 12 and 1 <= d <= days_in_month(y, mo) and h < 24 and mi < 60 and sec < 60:
+            return days_from_civil(y, mo, d) * 86400 + h * 3600 + mi * 60 + sec
+    return None
+
+# Creates the compiled version of iso_to_seconds with the given numba module.
+# Numba is optional, it is only imported and the functions are only compiled when a huge time file with lines of different lengths is parsed
+def make_iso_buffer_to_seconds(numba):
+    days_from_civil_jit = numba.njit(days_from_civil)
+
+    # Returns the number written with the n digits at buf[p:p+n], or -1 if one of them is not a digit
+    @numba.njit
+    def read_digits(buf, p, n):
+        v = 0
+        for j in range(p, p + n):
+            c = np.int64(buf[j]) - 48
+            if c < 0 or c > 9:
+                return -1
+            v = v * 10 + c
+        return v
+
+    # Compiled version of iso_to_seconds, working directly on the bytes of all lines.
+    # buf holds the lines, starts and lengths give the position of each line in buf.
+    # Returns the seconds and a flag for each line - lines that don't have the fixed-width format are not flagged
+    # and are left to numpy
+    @numba.njit
+    def iso_buffer_to_seconds(buf, starts, lengths):
+        n = starts.shape[0]
+        seconds = np.zeros(n, np.int64)
+        ok = np.zeros(n, np.bool_)
+        for i in range(n):
+            p = starts[i]
+            k = lengths[i]
+            sign = 1
+            if k == 20 and buf[p] == 45:   # '-'
+                sign = -1
+                p += 1
+                k -= 1
+            # 'YYYY-MM-DDTHH:MM:SS'
+            if k != 19 or buf[p+4] != 45 or buf[p+7] != 45 or buf[p+10] != 84 or buf[p+13] != 58 or buf[p+16] != 58:
+                continue
+            y = read_digits(buf, p, 4)
+            mo = read_digits(buf, p+5, 2)
+            d = read_digits(buf, p+8, 2)
+            h = read_digits(buf, p+11, 2)
+            mi = read_digits(buf, p+14, 2)
+            sec = read_digits(buf, p+17, 2)
+            if y < 0 or not (1 <= mo <= 12 and 0 <= h < 24 and 0 <= mi < 60 and 0 <= sec < 60):
+                continue
+            y = sign * y
+            # same as days_in_month, which can't be called from the compiled code
+            month_days = days_from_civil_jit(y + (mo == 12), mo % 12 + 1, 1) - days_from_civil_jit(y, mo, 1)
+            if not 1 <= d <= month_days:
+                continue
+            seconds[i] = days_from_civil_jit(y, mo, d) * 86400 + h * 3600 + mi * 60 + sec
+            ok[i] = True
+        return seconds, ok
+
+    return iso_buffer_to_seconds
+
+# Vectorized version of iso_to_seconds, used when all lines have the same length.
+# records is a 2D uint8 array with the bytes of one line (including its line break) per row, the digits are
+# read column-wise for all lines at once. Returns the seconds and a flag for each line, like iso_buffer_to_seconds
+def iso_records_to_seconds(records):
+    offset = records.shape[1] - 20   # 1 if the years have a minus sign, 0 otherwise
+    if offset:
+        ok = records[:, 0] == 45   # '-'
+        sign = np.where(ok, -1, 1)
+    else:
+        ok = np.ones(records.shape[0], dtype=bool)
+        sign = 1
+    digits = records[:, offset:offset+19].astype(np.int64) - 48
+    # 'YYYY-MM-DDTHH:MM:SS'
+    ok &= (digits[:, [4, 7]] == 45 - 48).all(axis=1) & (digits[:, 10] == 84 - 48) & (digits[:, [13, 16]] == 58 - 48).all(axis=1)
+    numbers = digits[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]]
+    ok &= ((numbers >= 0) & (numbers <= 9)).all(axis=1)
+    y = digits[:, 0:4] @ [1000, 100, 10, 1]
+    mo, d, h, mi, sec = (digits[:, p:p+2] @ [10, 1] for p in (5, 8, 11, 14, 17))
+    y = sign * y
+    ok &= (1 <= mo) & (mo <= 12) & (1 <= d) & (d <= days_in_month(y, mo)) & (h < 24) & (mi < 60) & (sec < 60)
+    seconds = days_from_civil(y, mo, d) * 86400 + h * 3600 + mi * 60 + sec
+    return seconds, ok
+
+# The pipeline information keys are static, so they are fetched only once and stored for this and the other passes
+if not hasattr(self, "ts_key"):
+    self.ts_key = vtk.vtkStreamingDemandDrivenPipeline.TIME_STEPS()
+    self.tr_key = vtk.vtkStreamingDemandDrivenPipeline.TIME_RANGE()
+    self.upd_key = vtk.vtkStreamingDemandDrivenPipeline.UPDATE_TIME_STEP()
+ts_key = self.ts_key
+tr_key = self.tr_key
+
+# The time file is only read and parsed again if another time file was set above, if the file was modified since the last pass
+# or if this script was edited (e.g. the annotation format below) - the pipeline calls RequestInformation also on changes
+# that have nothing to do with the times.
+# The script text is taken from the filter if this ParaView version offers a getter for it, otherwise the compiled code
+# of this script is used, which changes as well whenever the script is edited
+get_information_script = getattr(self, "GetInformationScript", None)
+if get_information_script is not None:
+    script_key = hash(get_information_script())
+else:
+    script_key = hash(marshal.dumps(sys._getframe().f_code))
+time_file_state = (time_file, os.stat(time_file).st_mtime, script_key)
 
-if not hasattr(self, "custom_times"):
+# Everything parsed from the file is first kept in local variables and only stored on self after all checks below passed,
+# so that a failed parse doesn't leave a mix of new and old time steps/annotations behind
+parse_time_file = not getattr(self, "initialized", False) or getattr(self, "time_file_state", None) != time_file_state
+
+if parse_time_file:
     with open(time_file, "r") as f:
-        lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        lines = time_line_re.findall(f.read())
 
     if not lines:
         raise RuntimeError("TXT file empty!")
 
-    # Splits a string like '-4000-01-01T00:00:00' into date and time parts.
-    # Returns a tuple (date_part, time_part)
-    def parse_date(s):
-        str = s.strip()
-        if 'T' not in s:
-            raise ValueError(f"Invalid format, no 'T' separator: {str!r}")
-        
-        date_part, time_part = s.split('T', 1)   # split only on 'T'
-        if not date_part or not time_part:
-            raise ValueError(f"Incomplete date-time string: {s!r} ? date={date_part!r}, time={time_part!r}")
-            
-        return date_part, time_part
+    # Every line must look like '-4000-01-01T00:00:00', i.e. contain a date and a time part separated by 'T'
+    for line in lines:
+        if 'T' not in line:
+            raise ValueError(f"Invalid format, no 'T' separator: {line!r}")
+        if line.startswith('T') or line.endswith('T'):
+            raise ValueError(f"Incomplete date-time string: {line!r}")
 
-    # Reference: the first date/time listed in the text file (time_file) becomes the reference date/time
-    ref_date = np.datetime64(lines[0])
-    
-    ref_date_str, ref_time_str = parse_date(lines[0])      
-    self.new_units = f"seconds since {ref_date_str} {ref_time_str}"
+    # All lines joined with line breaks, used below for the annotations and for the conversion of the dates
+    joined_lines = "\n".join(lines)
 
     # Store the time_file lines for later annotation in the '-4000-01-01 00:00:00' format - 
     # modify below if you wish a different format. 
     # We will use the array we create here, self.custom_times_annotation, later in the "Script" field, where we will add it to the output arrays
     # so that it will become an attribute of the data and if desired it can be displayed with the help of an AnnotateAttributeData in the 3D viewport
-    custom_times_annotation = []
-    for line in lines:
-        date, time = parse_date(line)
-        custom_times_annotation.append(date+" "+time)
-       
-    self.custom_times_annotation = custom_times_annotation    
+    # The 'T' separators of all lines are replaced in a single pass over the joined lines
+    custom_times_annotation = joined_lines.replace("T", " ").split("\n")
+
+    # The "current_date" array of each time step is created by RequestData the first time the step is shown and kept here,
+    # so revisiting a time step doesn't allocate a new string array, and the parse of a huge time file doesn't create one VTK object per line
+    current_date_arrays = [None] * len(custom_times_annotation)
+
+    # Reference: the first date/time listed in the text file (time_file) becomes the reference date/time
+    new_units = f"seconds since {custom_times_annotation[0]}"
+
+    # The "time_units" array is the same for all time steps, so it is also created only once and added to the output in RequestData
+    units_array = vtk.vtkStringArray()
+    units_array.SetName("time_units")
+    units_array.SetNumberOfValues(1)
+    units_array.SetValue(0, new_units)
     
 
     # Compute custom times: seconds since reference (works with BCE as well)
-    custom_times = []
-    for line in lines:
-        current_date = np.datetime64(line)
-        delta = current_date - ref_date
-        seconds_since_ref = delta.astype('timedelta64[s]').astype(int)
-        custom_times.append(float(seconds_since_ref))        
+    # All dates are converted to seconds since 1970 first, then the reference is subtracted once for the whole array
+    custom_times_np = None
+    raw = (joined_lines + "\n").encode("utf-8")
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    # The fast paths only work for pure ASCII files, where the positions of the characters and of the bytes are the same
+    if len(raw) == lengths.sum() + len(lines):
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        if lengths[0] in (19, 20) and (lengths == lengths[0]).all():
+            # all lines have the same length (e.g. all of them BCE dates), so the buffer can be viewed as a table with one line per row
+            records = buf.reshape(len(lines), lengths[0] + 1)
+            if len(lines) > large_time_file_lines:
+                # numpy releases the GIL in its array operations, so the table of a huge time file is split and parsed by several threads
+                chunks = np.array_split(records, os.cpu_count() or 1)
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    results = list(executor.map(iso_records_to_seconds, chunks))
+                custom_times_np = np.concatenate([seconds for seconds, _ in results])
+                ok = np.concatenate([chunk_ok for _, chunk_ok in results])
+            else:
+                custom_times_np, ok = iso_records_to_seconds(records)
+        elif len(lines) > large_time_file_lines:
+            # huge time file with lines of different lengths (e.g. dates before and after year 0):
+            # if numba is available in ParaView's Python, the dates are converted by a compiled loop
+            try:
+                import numba
+            except ImportError:
+                numba = None
+            if numba is not None:
+                starts = np.zeros_like(lengths)
+                np.cumsum(lengths[:-1] + 1, out=starts[1:])
+                custom_times_np, ok = make_iso_buffer_to_seconds(numba)(buf, starts, lengths)
+    if custom_times_np is None:
+        seconds = [iso_to_seconds(line) for line in lines]
+        ok = np.array([v is not None for v in seconds], dtype=bool)
+        custom_times_np = np.array([v or 0 for v in seconds], dtype=np.int64)
+    if ok.all():
+        custom_times_np -= custom_times_np[0]
+    else:
+        # The remaining lines (e.g. with fractional seconds) are converted by numpy, all of them with a single datetime64 array.
+        # Like np.datetime64 did for each line, the reference is subtracted in the finest unit of the dates and only the differences
+        # are rounded down to seconds, so they match new_units also if the first date has fractional seconds
+        rest = np.flatnonzero(~ok)
+        parsed = np.array([lines[i] for i in rest], dtype='datetime64')
+        custom_times_np[rest] = 0
+        dates = custom_times_np.view('datetime64[s]').astype(np.result_type(parsed.dtype, np.dtype('datetime64[s]')))
+        dates[rest] = parsed
+        # viewing the timedelta64[s] values as int64 gives the seconds without another copy
+        custom_times_np = (dates - dates[0]).astype('timedelta64[s]').view('int64')
+    # ParaView expects the time steps in increasing order, the lookups in the later passes rely on it as well
+    if (custom_times_np[1:] <= custom_times_np[:-1]).any():
+        raise ValueError("The dates in the TXT file must be in increasing order!")
+    # VTK expects Python floats when appending the time steps, the int64 array is kept for fast lookups
+    custom_times = custom_times_np.astype(np.float64).tolist()
+
+    # Maps each custom time to its index, so the later passes don't have to search the list on every frame.
+    # Internally the time steps are identified by this integer index, the float values are only needed for VTK:
+    # the keys are the exact doubles handed to TIME_STEPS, so the times ParaView requests back normally hit the dict directly,
+    # the binary search in the later passes only runs if a value drifted on its way through the pipeline
+    custom_times_index = {t: i for i, t in enumerate(custom_times)}
+else:
+    custom_times = self.custom_times
+
+# Get original times from input (for mapping)
+# These are fetched on every pass, since the input might have changed even if the time file did not
+inInfo = self.GetInputInformation(0, 0)
 
-    # Get original times from input (for mapping)
-    inInfo = self.GetInputInformation(0, 0)
-    ts_key = vtk.vtkStreamingDemandDrivenPipeline.TIME_STEPS()
 
-    
-    num_ts = inInfo.Length(ts_key)
-    if num_ts != len(custom_times):
-        raise ValueError(f"Number of dates in file ({len(custom_times)}) doesn't match time steps in data ({num_ts})!")
-    orig_times = [inInfo.Get(ts_key, i) for i in range(num_ts)]
+num_ts = inInfo.Length(ts_key)
+if num_ts != len(custom_times):
+    raise ValueError(f"Number of dates in file ({len(custom_times)}) doesn't match time steps in data ({num_ts})!")
+orig_times = np.fromiter((inInfo.Get(ts_key, i) for i in range(num_ts)), dtype=np.float64, count=num_ts)
 
-    # Store everything for other passes
+# Store everything for other passes
+if parse_time_file:
+    self.custom_times_annotation = custom_times_annotation
+    self.current_date_arrays = current_date_arrays
+    self.new_units = new_units
+    self.units_array = units_array
     self.custom_times = custom_times
-    self.orig_times = orig_times
+    self.custom_times_np = custom_times_np
+    self.custom_times_index = custom_times_index
+    self.time_file_state = time_file_state
     self.initialized  = True
+self.orig_times = orig_times
+
+# The names of the input's time units arrays are looked up again in the first RequestData after this pass
+self.time_units_array_names = None
 
 # Provide custom times to the pipeline
 outInfo = self.GetOutputInformation(0)
-#ts_key = vtk.vtkStreamingDemandDrivenPipeline.TIME_STEPS()
-tr_key = vtk.vtkStreamingDemandDrivenPipeline.TIME_RANGE()
 
 
 if outInfo.Has(ts_key):
@@ -121,9 +319,14 @@ if outInfo.Has(ts_key):
 if outInfo.Has(tr_key):
     outInfo.Remove(tr_key)
 
-# Append custom times to output
-for t in self.custom_times:
-    outInfo.Append(ts_key, t)
+# Set all custom times on the output in a single call
+# TIME_STEPS is a double vector key, so the whole list can be handed over at once, like the range below
+try:
+    outInfo.Set(ts_key, self.custom_times, len(self.custom_times))
+except TypeError:
+    # fallback for VTK versions whose wrapper doesn't offer the vector setter: append one by one
+    for t in self.custom_times:
+        outInfo.Append(ts_key, t)
 
 # Set up the custom times range
 if self.custom_times:
@@ -138,15 +341,18 @@ if self.custom_times:
 # Manages/modifies the update extent/time that will be requested from the upstream inputs based on what the filter is asking downstream for on the output
 
 # Get requested custom time
-upd_key = vtk.vtkStreamingDemandDrivenPipeline.UPDATE_TIME_STEP()
+# (the key was stored in RequestInformation)
+upd_key = self.upd_key
 requested_time = self.GetOutputInformation(0).Get(upd_key)
 
 # Map to original time index
 if requested_time is not None:
-    try:
-        idx = self.custom_times.index(requested_time)
-    except ValueError:
-        idx = 0  # fallback to first
+    idx = self.custom_times_index.get(requested_time)
+    if idx is None:
+        # fallback for times that don't match exactly (e.g. rounding): binary search for the closest custom time
+        idx = int(self.custom_times_np.searchsorted(requested_time))
+        if idx == len(self.custom_times_np) or (idx > 0 and requested_time - self.custom_times_np[idx-1] < self.custom_times_np[idx] - requested_time):
+            idx -= 1
 else:
     idx = 0
   
@@ -155,9 +361,11 @@ else:
 inInfo = self.GetInputInformation(0, 0)
 if inInfo.Has(upd_key):
     inInfo.Remove(upd_key)
-inInfo.Set(upd_key, self.orig_times[idx])
+# self.orig_times is a numpy array, float() makes sure the VTK wrapper gets a plain Python float
+inInfo.Set(upd_key, float(self.orig_times[idx]))
 
-self.current_requested_custom_time = self.GetOutputInformation(0).Get(vtk.vtkStreamingDemandDrivenPipeline.UPDATE_TIME_STEP())
+# Save the index for RequestData, which is always called after this pass for the same time step
+self.current_idx = idx
 
 
 #----------------------------------------------------------------------------------------------------------------------------
@@ -177,44 +385,41 @@ output.ShallowCopy(inputData)
 # Fix the time:units attribute
 fieldData = output.GetFieldData()
 
-arrays_to_remove = []
-for i in range(fieldData.GetNumberOfArrays()):
-    name = fieldData.GetArrayName(i)
-    if name is not None and ("time" in name.lower() and "units" in name.lower()):
-        arrays_to_remove.append(name)
-
-for name in arrays_to_remove:
+# The time units arrays are the same for all time steps of an input, so we search for them only once
+# and remember their names (RequestInformation resets them whenever the pipeline information changes)
+if getattr(self, "time_units_array_names", None) is None:
+    arrays_to_remove = []
+    for i in range(fieldData.GetNumberOfArrays()):
+        name = fieldData.GetArrayName(i)
+        # "time_units" doesn't need to be removed, AddArray below replaces an array with the same name
+        if name is not None and name != "time_units" and ("time" in name.lower() and "units" in name.lower()):
+            arrays_to_remove.append(name)
+    self.time_units_array_names = arrays_to_remove
+
+for name in self.time_units_array_names:
     fieldData.RemoveArray(name)
 
 # Add new units to the output arrays
 # - this will show up in the "Properties" tab, under the Data Arrays list
-str_array = vtk.vtkStringArray()
-str_array.SetName("time_units")
-str_array.SetNumberOfValues(1)
-str_array.SetValue(0, self.new_units)
-fieldData.AddArray(str_array)
+# The array with self.new_units was created in RequestInformation
+fieldData.AddArray(self.units_array)
              
 
-# Use the value we saved in RequestUpdateExtent 
-if hasattr(self, "current_requested_custom_time"):
-    current_custom_time = self.current_requested_custom_time
-else:
-    # fallback for the first frame
-    current_custom_time = self.custom_times[0]   
-
-# Find index
-try:
-    idx = self.custom_times.index(current_custom_time)
-except ValueError:
-    idx = 0
+# Use the index we saved in RequestUpdateExtent, so the requested time doesn't have to be searched again
+# (fallback for the first frame: the first time step)
+idx = getattr(self, "current_idx", 0)
 
 # Add the array with the date/time read from the text file (ie. self.custom_times_annotation) as the "current date" array to the output arrays 
 # - this will show up as an attribute in the "Properties" tab,under the Data Arrays list
 # This will also make it possible to apply an AnnotateAttributeData filter to our Programmable Filter,
 # so that the date/time will be displayed in the 3D viewport corresponding to the current time step
-date_array = vtk.vtkStringArray()
-date_array.SetName("current_date")
 #We created in RequestInformation the self.custom_times_annotation list with dates in the '-4000-01-01 00:00:00' format
-date_array.InsertNextValue(self.custom_times_annotation[idx])
+date_array = self.current_date_arrays[idx]
+if date_array is None:
+    # first time this time step is shown: create its array and keep it for the next visits
+    date_array = vtk.vtkStringArray()
+    date_array.SetName("current_date")
+    date_array.InsertNextValue(self.custom_times_annotation[idx])
+    self.current_date_arrays[idx] = date_array
 output.GetFieldData().AddArray(date_array)
 